@@ -13,10 +13,16 @@ Soyluca Onaylayıcı Bot
 """
 
 import asyncio
+import functools
 import logging
 import os
+import random
+import sqlite3
+import threading
+from time import monotonic, time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
     ChatJoinRequestHandler,
@@ -24,24 +30,255 @@ from telegram.ext import (
     CommandHandler,
     ContextTypes,
 )
+from telegram.request import HTTPXRequest
 
-# Log
+try:
+    import uvloop  # Linux'ta daha hızlı event loop; yoksa varsayılan asyncio
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson  # Telegram yanıtlarını hızlı çözmek için; yoksa standart json
+except ImportError:
+    orjson = None
+
+# Log (LOG_LEVEL=WARNING ile üretimde daha az çıktı)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
+    level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
 )
+# httpx her API çağrısını INFO'da loglar; toplu onayda binlerce satır eder.
+# DEBUG'da ise bu kayıtlar hata ayıklamak için gerekli, dokunma.
+if logging.getLogger().getEffectiveLevel() > logging.DEBUG:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Ortam değişkenleri
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
+PUBLIC_URL = os.getenv("PUBLIC_URL")            # webhook için (örn. https://bot.example.com)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")    # opsiyonel
+PORT = int(os.getenv("PORT", "8443"))
+TG_API_BASE_URL = os.getenv("TG_API_BASE_URL")  # yerel Bot API sunucusu (örn. http://localhost:8081/bot)
+# Bekleyen isteklerin SQLite dosyası. Yeniden başlatmada korunması için kalıcı
+# bir diske işaret etmeli: Heroku'da uygulama dizini her restart/deploy'da
+# silinir, varsayılan yol (çalışma dizini) sadece yerel geliştirme içindir.
+DB_PATH = os.getenv("DB_PATH", "pending.db")
+PENDING_TTL = int(os.getenv("PENDING_TTL", "0"))  # sn; bundan eski istekler silinir (0 = kapalı)
+ADMIN_IDS: frozenset[int] = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x)
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "20"))
+DRAIN_BATCH = 8  # işçi başına bir uyanışta kuyruktan alınan en fazla kullanıcı
+
+# Ağ hatalarında üstel bekleme (sn)
+_BACKOFF_BASE = 1.0
+_BACKOFF_CAP = 30.0
+_BACKOFF_MAX_RETRIES = 8
+
+# Bu hatalar isteğin artık olmadığını gösterir (başka yerden işlenmiş / geri çekilmiş)
+_GONE_ERRORS = frozenset({"HIDE_REQUESTER_MISSING", "USER_ALREADY_PARTICIPANT"})
+
+# Hız adı -> saniyedeki onay sayısı ("HIZLI".lower() == "hizli" olduğu için ASCII karşılıklar da var)
+_RATE = {
+    "hızlı": 20, "hizli": 20, "fast": 20,
+    "orta": 12, "medium": 12,
+    "yavaş": 5, "yavas": 5, "slow": 5,
+}
 
 if not BOT_TOKEN:
     raise SystemExit("BOT_TOKEN env zorunlu")
 
-# Bekleyen istekler
-pending_requests = {}  # {chat_id: [user_id1, user_id2]}
+# Kalıcı kayıt: bot yeniden başlasa da bekleyen istekler kaybolmaz
+db = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+db.execute(
+    "CREATE TABLE IF NOT EXISTS pending("
+    "chat_id INTEGER, user_id INTEGER, first_name TEXT, requested_at REAL, "
+    "PRIMARY KEY(chat_id, user_id))"
+)
+db_lock = threading.Lock()
+
+
+def db_write(sql, rows):
+    """asyncio.to_thread ile çağrılır; bağlantı thread'ler arasında paylaşılır."""
+    with db_lock:
+        db.executemany(sql, rows)
+
+
+def db_expire(cutoff):
+    """`cutoff` zamanından önceki istekleri siler ve (chat_id, user_id) listesini döner."""
+    with db_lock:
+        rows = db.execute(
+            "SELECT chat_id, user_id FROM pending WHERE requested_at < ?", (cutoff,)
+        ).fetchall()
+        db.execute("DELETE FROM pending WHERE requested_at < ?", (cutoff,))
+    return rows
+
+
+# Bekleyen istekler (veritabanının bellekteki kopyası)
+pending_requests = {}  # {chat_id: {user_id1, user_id2}}
 selected_chat = {}     # {admin_id: chat_id}
+approve_lock = asyncio.Lock()  # flood limiti bot geneli: aynı anda tek /onayla çalışır
+
+_SEC_PREFIX = "sx:"    # /sec klavyesinin callback_data öneki (chat_id onaltılık)
+
+for _chat_id, _user_id in db.execute("SELECT chat_id, user_id FROM pending"):
+    pending_requests.setdefault(_chat_id, set()).add(_user_id)
+
+
+class RateLimiter:
+    """Saniyede en fazla `rate` çağrıya izin verir (monotonic saat ile)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        now = monotonic()
+        slot = max(self._next, now)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _log_approve_error(uid, e):
+    # Toplu onayda her hata için traceback üretme; sadece DEBUG'da
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.exception("Onaylama hatası uid=%d", uid)
+    else:
+        logger.warning("Onaylama hatası uid=%d %s: %s", uid, type(e).__name__, e)
+
+
+async def _approve_one(bot, chat_id, uid, limiter, gate):
+    """Tek isteği onaylar; her deneme kendi hız sınırı yerini bekler.
+
+    Onaylanırsa True, istek artık yoksa None, başarısızsa False döner.
+
+    RetryAfter gelirse `gate` kapatılır; ağ hatalarında üstel bekleme ile
+    en fazla _BACKOFF_MAX_RETRIES kez tekrar denenir.
+    """
+    retries = 0
+    timed_out = False  # zaman aşımına uğrayan çağrı Telegram'da işlenmiş olabilir
+    while True:
+        await gate.wait()
+        await limiter.wait()
+        try:
+            await bot.approve_chat_join_request(chat_id, uid)
+            return True
+        except RetryAfter as e:
+            logger.warning("Flood limiti, %s sn bekleniyor", e.retry_after)
+            gate.clear()
+            await asyncio.sleep(e.retry_after + 0.5)
+            gate.set()
+        except NetworkError as e:
+            # BadRequest de NetworkError'dır ama tekrar denemek işe yaramaz
+            if isinstance(e, BadRequest) and e.message.upper() in _GONE_ERRORS:
+                if timed_out:
+                    return True  # önceki deneme aslında onaylamış
+                logger.info("İstek artık yok uid=%d chat=%d: %s", uid, chat_id, e.message)
+                return None
+            if isinstance(e, BadRequest) or retries >= _BACKOFF_MAX_RETRIES:
+                _log_approve_error(uid, e)
+                return False
+            timed_out = timed_out or isinstance(e, TimedOut)
+            delay = min(_BACKOFF_CAP, _BACKOFF_BASE * 2**retries) + random.uniform(0, 0.5)
+            retries += 1
+            logger.warning(
+                "Ağ hatası uid=%d chat=%d, %.1f sn sonra tekrar (%d/%d): %s",
+                uid, chat_id, delay, retries, _BACKOFF_MAX_RETRIES, e,
+            )
+            await asyncio.sleep(delay)
+        except Exception as e:
+            _log_approve_error(uid, e)
+            return False
+
+
+async def _approve_worker(bot, chat_id, queue, outstanding, limiter, gate):
+    """Kuyruktan kullanıcı alıp onaylar; onaylanan sayısını döner.
+
+    `gate` tüm işçiler arasında ortaktır: biri RetryAfter alınca hepsi bekler.
+    Kaydı silinen kullanıcılar `outstanding` kümesinden çıkarılır;
+    onaylanamayanlar orada kalır. Artık var olmayan isteklerin kaydı
+    onaylananlar gibi silinir ama sayılmaz. Her uyanışta kuyrukta hazır
+    bekleyen en fazla DRAIN_BATCH kullanıcı alınır.
+    """
+    count = 0
+    while True:
+        batch = [await queue.get()]
+        # Durdurma işaretinden (None) sonrası diğer işçilere aittir
+        while len(batch) < DRAIN_BATCH and batch[-1] is not None and not queue.empty():
+            batch.append(queue.get_nowait())
+        done = batch[-1] is None
+        if done:
+            batch.pop()
+        finished = []
+        for uid in batch:
+            result = await _approve_one(bot, chat_id, uid, limiter, gate)
+            if result is False:
+                continue
+            finished.append((chat_id, uid))
+            if result:
+                count += 1
+        if finished:
+            await asyncio.to_thread(
+                db_write, "DELETE FROM pending WHERE chat_id = ? AND user_id = ?", finished
+            )
+            outstanding.difference_update(uid for _, uid in finished)
+        if done:
+            return count
+
+
+async def _approve_chat(bot, chat_id, users, speed):
+    """`users` kümesindeki istekleri işçilerle onaylar; onaylanan sayısını döner."""
+    limiter = RateLimiter(_RATE.get(speed, _RATE["orta"]))
+    gate = asyncio.Event()
+    gate.set()
+    queue = asyncio.Queue(maxsize=BULK_CONCURRENCY * 2)
+    # Kümeden çekilip kaydı henüz silinmeyenler (kuyrukta, işlemde veya başarısız)
+    outstanding = set()
+
+    # Bir işçi beklenmedik şekilde çökerse TaskGroup diğerlerini de iptal eder.
+    # Kuyruk sınırlı: işçiler ilk kullanıcıdan itibaren onaylamaya başlar,
+    # kuyruğu doldurmak ile onaylar aynı anda ilerler.
+    try:
+        async with asyncio.TaskGroup() as tg:
+            workers = [
+                tg.create_task(_approve_worker(bot, chat_id, queue, outstanding, limiter, gate))
+                for _ in range(BULK_CONCURRENCY)
+            ]
+            # Kopya yerine doğrudan kümeden çek
+            while users:
+                uid = users.pop()
+                outstanding.add(uid)
+                await queue.put(uid)
+            for _ in workers:
+                await queue.put(None)
+    finally:
+        # Hata veya iptalde de bitmeyenler bekleyenlere geri döner
+        users |= outstanding
+    return sum(w.result() for w in workers)
+
+
+class OrjsonRequest(HTTPXRequest):
+    """Telegram yanıtlarını orjson ile çözen HTTPXRequest."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Bozuk UTF-8 vb. durumlarda PTB'nin kendi davranışına dön
+            return HTTPXRequest.parse_json_payload(payload)
+
+
+def admin_only(func):
+    """Komutu sadece ADMIN_IDS içindeki kullanıcılara açar."""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ADMIN_IDS:
+            return await update.message.reply_text("⛔ Yetkin yok")
+        return await func(update, context)
+    return wrapper
 
 
 # Komutlar
@@ -56,12 +293,9 @@ async def my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@admin_only
 async def list_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Tüm gruplardaki bekleyen istekleri listeler"""
-    user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
-        return await update.message.reply_text("⛔ Yetkin yok")
-
     text = "📋 Bekleyen istekler:\n"
     if not pending_requests:
         text += "Hiç bekleyen istek yok."
@@ -71,33 +305,28 @@ async def list_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_html(text)
 
 
+@admin_only
 async def sec_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Kanal/grup seç"""
-    user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
-        return await update.message.reply_text("⛔ Yetkin yok")
-
     if not pending_requests:
         return await update.message.reply_text("Hiç bekleyen istek yok.")
 
     keyboard = []
     for chat_id, users in pending_requests.items():
-        keyboard.append([InlineKeyboardButton(f"{chat_id} ({len(users)} istek)", callback_data=f"sec:{chat_id}")])
+        keyboard.append([InlineKeyboardButton(f"{chat_id} ({len(users)} istek)", callback_data=_SEC_PREFIX + format(chat_id, "x"))])
 
     await update.message.reply_text("Bir grup seç:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+@admin_only
 async def approve_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Seçilen gruptaki istekleri onayla"""
     user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
-        return await update.message.reply_text("⛔ Yetkin yok")
-
     chat_id = selected_chat.get(user_id)
     if not chat_id:
         return await update.message.reply_text("⚠️ Önce /sec ile bir grup seç.")
 
-    users = pending_requests.get(chat_id, [])
+    users = pending_requests.get(chat_id, set())
     if not users:
         return await update.message.reply_text("✅ Bekleyen istek yok.")
 
@@ -106,25 +335,17 @@ async def approve_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args:
         speed = context.args[0].lower()
 
-    delay = 0.5
-    if speed == "hızlı":
-        delay = 0.1
-    elif speed == "yavaş":
-        delay = 1.5
-
-    count = 0
-    for uid in list(users):
-        try:
-            await context.bot.approve_chat_join_request(chat_id, uid)
-            users.remove(uid)
-            count += 1
-            await asyncio.sleep(delay)
-        except Exception as e:
-            logger.error("Onaylama hatası: %s", e)
+    # Eşzamanlı iki çalışma (farklı gruplarda bile) hız sınırını ikiye katlar
+    # ve RetryAfter beklemesini paylaşmaz
+    if approve_lock.locked():
+        return await update.message.reply_text("⏳ Başka bir onaylama zaten sürüyor.")
+    async with approve_lock:
+        count = await _approve_chat(context.bot, chat_id, users, speed)
 
     await update.message.reply_text(f"✅ {count} istek onaylandı. ({speed})")
 
 
+@admin_only
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Seçimi iptal et"""
     user_id = update.effective_user.id
@@ -138,16 +359,34 @@ async def on_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = req.from_user
     chat = req.chat
 
-    pending_requests.setdefault(chat.id, []).append(user.id)
+    # Önce kalıcı kayıt: onay, satır yazılmadan bellekten alınıp silinemesin
+    await asyncio.to_thread(
+        db_write,
+        "INSERT INTO pending(chat_id, user_id, first_name, requested_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(chat_id, user_id) DO UPDATE SET "
+        "requested_at = excluded.requested_at, first_name = excluded.first_name",
+        [(chat.id, user.id, user.first_name, req.date.timestamp())],
+    )
+    pending_requests.setdefault(chat.id, set()).add(user.id)
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                admin_id,
-                f"📩 Yeni istek: {user.full_name} ({user.id}) → {chat.title} ({chat.id})",
-            )
-        except:
-            pass
+    text = f"📩 Yeni istek: {user.full_name} ({user.id}) → {chat.title} ({chat.id})"
+    # Yöneticilere aynı anda gönder; bir hata diğerlerini etkilemez
+    results = await asyncio.gather(
+        *(context.bot.send_message(admin_id, text) for admin_id in ADMIN_IDS),
+        return_exceptions=True,
+    )
+    for admin_id, result in zip(ADMIN_IDS, results):
+        if isinstance(result, Exception):
+            logger.warning("Admin bildirimi hatası (%s): %s", admin_id, result)
+
+
+# Eski istekleri temizle (PENDING_TTL > 0 ise)
+async def sweep_pending(context: ContextTypes.DEFAULT_TYPE):
+    rows = await asyncio.to_thread(db_expire, time() - PENDING_TTL)
+    for chat_id, user_id in rows:
+        pending_requests.get(chat_id, set()).discard(user_id)
+    if rows:
+        logger.info("%d eski istek silindi", len(rows))
 
 
 # Callback (seçim için)
@@ -156,14 +395,57 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = update.effective_user.id
 
-    if query.data.startswith("sec:"):
-        chat_id = int(query.data.split(":")[1])
+    data = query.data
+    if data.startswith(_SEC_PREFIX):
+        chat_id = int(data[len(_SEC_PREFIX):], 16)
         selected_chat[user_id] = chat_id
         await query.edit_message_text(f"✅ {chat_id} seçildi.")
+    elif data.startswith("sec:"):
+        # Ondalık chat_id taşıyan eski /sec düğmeleri
+        await query.edit_message_text("⚠️ Bu düğme eski, /sec ile tekrar seç.")
 
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    # Procfile'da web ve worker aynı app.py'yi çalıştırır; mod PUBLIC_URL ile seçilir.
+    # Yanlış süreçte çalışmak iki botun güncellemeler için çekişmesine yol açar.
+    if "PORT" in os.environ and not PUBLIC_URL:
+        raise SystemExit("PORT tanımlı ama PUBLIC_URL yok: web süreci webhook için PUBLIC_URL ister, "
+                         "yoklama (polling) için worker sürecini kullan")
+    if PUBLIC_URL and os.getenv("DYNO", "").startswith("worker."):
+        raise SystemExit("PUBLIC_URL tanımlı: webhook modunda worker değil web süreci çalıştırılmalı")
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    request_cls = OrjsonRequest if orjson is not None else HTTPXRequest
+
+    # Toplu onayda işçiler ve yönetici bildirimleri bağlantı havuzunda sıraya girmesin
+    request = request_cls(
+        connection_pool_size=max(64, BULK_CONCURRENCY * 2),
+        connect_timeout=5,
+        read_timeout=30,
+        write_timeout=15,
+        pool_timeout=5,
+        http_version="2",
+    )
+    # getUpdates uzun yoklaması kendi bağlantısını kullanır
+    # (PTB yoklama süresini read_timeout'a kendisi ekler)
+    updates_request = request_cls(connect_timeout=5, read_timeout=5)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(updates_request)
+        .concurrent_updates(32)
+    )
+    if TG_API_BASE_URL:
+        # Aynı makinedeki telegram-bot-api sunucusu: her çağrı api.telegram.org'a gitmez
+        builder = (
+            builder.base_url(TG_API_BASE_URL)
+            .base_file_url(TG_API_BASE_URL.removesuffix("/bot") + "/file/bot")
+            .local_mode(True)
+        )
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("id", my_id))
@@ -174,8 +456,22 @@ def main():
     app.add_handler(ChatJoinRequestHandler(on_join_request))
     app.add_handler(CallbackQueryHandler(button_handler))
 
+    if PENDING_TTL > 0:
+        app.job_queue.run_repeating(sweep_pending, interval=300, first=60)
+
     logger.info("Bot başlıyor…")
-    app.run_polling()
+    if PUBLIC_URL:
+        # Webhook: Telegram güncellemeleri kendisi gönderir, getUpdates döngüsü yok
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        # Uzun yoklama: Telegram bağlantıyı yeni güncelleme gelene kadar 30 sn açık tutar
+        app.run_polling(poll_interval=0, timeout=30)
 
 
 if __name__ == "__main__":